@@ -1,10 +1,15 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
 import librouteros
 import re
+import time
+import bisect
+import itertools
 from datetime import datetime, timedelta
 import os
-import csv
+import io
+import sqlite3
 
 # Configuración y credenciales
 USERNAME = st.secrets["credentials"]["username"]
@@ -17,45 +22,107 @@ ROUTER_PASS = st.secrets.get("router", {}).get("password", "")
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 if "log_file" not in st.session_state:
-    st.session_state.log_file = "pppoe_connection_log.csv"
+    st.session_state.log_file = "pppoe_connection_log.db"
 
-# Función para conectar con el router MikroTik
+# Patrones precompilados para el análisis de logs
+# Todos los patrones de desconexión en una sola alternancia (una pasada por línea).
+# Los nombres de usuario no llevan espacios: \S+ en lugar de .* evita el backtracking
+_PPPOE_DISC_UNION = re.compile(
+    r"\bpppoe (?P<u1>\S+) disconnected"
+    r"|\bPPPoE connection closed for user (?P<u2>\S+)"
+    r"|\buser (?P<u3>\S+) disconnected"
+    r"|\bremoved pppoe client (?P<u4>\S+)"
+    r"|\bPPP user (?P<u5>\S+) closed",
+    re.IGNORECASE
+)
+# Términos que indican un log relacionado con PPPoE ('ppp' cubre también 'pppoe').
+# Se aplican sobre el mensaje ya pasado a minúsculas
+_TOPIC_HINT_RE = re.compile(r"ppp|disconnected|closed|terminating\.\.\.")
+# Todos los patrones de desconexión contienen 'ppp' o 'disconnected'
+_DISC_HINT_RE = re.compile(r"ppp|disconnected")
+_IP_RE = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})")
+_PPPOE_TAG_RE = re.compile(r"<pppoe-(.*?)>")
+
+# Separador para unir los mensajes: ningún patrón de desconexión puede atravesarlo
+_LOG_SEPARATOR = "\x1f\n"
+
+# Campos de las desconexiones, guardadas por columnas (una lista por campo)
+DISCONNECTION_FIELDS = ('nombre', 'ip', 'tiempo_desconexion', 'mensaje', 'topics')
+
+# Función para conectar con el router MikroTik (reutiliza la conexión de la sesión)
 def connect_to_mikrotik():
+    api = st.session_state.get("mk_api")
+    if api is not None:
+        return api
+    
     try:
         api = librouteros.connect(
             username=ROUTER_USER,
             password=ROUTER_PASS,
             host=ROUTER_IP
         )
+        st.session_state.mk_api = api
         return api
     except Exception as e:
         st.error(f"Error al conectar con el router: {str(e)}")
         return None
 
+# Función para descartar la conexión guardada; la siguiente llamada vuelve a conectar
+def reset_mikrotik_connection():
+    api = st.session_state.pop("mk_api", None)
+    if api is not None:
+        try:
+            api.close()
+        except Exception:
+            pass
+
+# Lectura cacheada de /ppp/active (el parámetro _api no forma parte de la clave del caché)
+@st.cache_data(ttl=10, show_spinner=False)
+def _fetch_active_pppoe(_api):
+    return tuple(_api.path('/ppp/active'))
+
 # Función para obtener usuarios PPPoE activos
 def get_active_pppoe_users():
     api = connect_to_mikrotik()
     if not api:
-        return {}
+        return pd.DataFrame(columns=['Cliente', 'IP'])
     
     try:
-        # Obtener lista de usuarios PPPoE activos
-        pppoe_active = api.path('/ppp/active')
-        active_clients = {}
-
-        for client in pppoe_active:
-            if 'name' in client and 'address' in client:
-                active_clients[client['name']] = {
-                    'ip': client['address'],
-                    'uptime': client.get('uptime', 'N/A'),
-                    'caller_id': client.get('caller-id', 'N/A'),
-                    'service': client.get('service', 'N/A')
-                }
-
-        return active_clients
+        # Obtener lista de usuarios PPPoE activos directamente como tabla
+        pppoe_active = _fetch_active_pppoe(api)
+        records = [
+            (client['name'], client['address'])
+            for client in pppoe_active
+            if 'name' in client and 'address' in client
+        ]
+
+        return pd.DataFrame.from_records(records, columns=['Cliente', 'IP'])
     except Exception as e:
+        reset_mikrotik_connection()
         st.error(f"Error al obtener usuarios activos: {str(e)}")
-        return {}
+        return pd.DataFrame(columns=['Cliente', 'IP'])
+
+# Función para preparar los logs una sola vez: (hora, mensaje, topics, mensaje en minúsculas)
+def preprocess_logs(raw_logs):
+    logs = []
+    for log in raw_logs:
+        # Una sola búsqueda por clave; los logs sin mensaje u hora se descartan
+        log_message = log.get('message')
+        if not log_message:
+            continue
+        log_time = log.get('time')
+        if not log_time:
+            continue
+        
+        logs.append((log_time, log_message, log.get('topics', ''), log_message.lower()))
+    
+    return logs
+
+# Lectura cacheada de /log: las recargas dentro del TTL reutilizan los mismos logs.
+# Solo se piden al router los campos que se usan después
+@st.cache_data(ttl=30, show_spinner=False)
+def _fetch_raw_logs(_api):
+    return tuple(preprocess_logs(_api.path('/log').select('time', 'message', 'topics')))
 
 # Función para obtener los logs del router MikroTik
 def get_mikrotik_logs(time_minutes=60):
@@ -65,122 +132,220 @@ def get_mikrotik_logs(time_minutes=60):
     
     try:
         # Obtener logs del sistema
-        log_path = api.path('/log')
+        log_path = _fetch_raw_logs(api)
         
-        # Aumentar la cantidad de logs para no perder ninguno
-        logs = list(log_path)[:time_minutes * 10]  # Aumentado para capturar más logs
+        # RouterOS devuelve los logs del más antiguo al más reciente:
+        # quedarse con los últimos para cubrir el período pedido
+        logs = list(log_path[-(time_minutes * 10):])
         
         return logs
     except Exception as e:
+        reset_mikrotik_connection()
         st.error(f"Error al obtener logs del router: {str(e)}")
         return []
     
 
 
-# Función para filtrar logs de desconexión PPPoE
-def filter_pppoe_disconnections(logs):
-    disconnections = []
-    pppoe_patterns = [
-        r"pppoe (.*) disconnected",
-        r"PPPoE connection closed for user (.*)",
-        r"user (.*) disconnected",
-        r"removed pppoe client (.*)",
-        r"PPP user (.*) closed"
-    ]
+# Función para analizar los logs (preparados con preprocess_logs) en una sola pasada:
+# devuelve las desconexiones PPPoE y los eventos de conexión
+# (desconexión, conexión, reconexión rápida)
+def scan_logs(logs):
+    disconnections = {field: [] for field in DISCONNECTION_FIELDS}
+    connection_events = []
+    candidates = []
     
-    now = datetime.now()
+    # Crear un diccionario para hacer seguimiento del estado de cada cliente
+    client_status = {}
     
-    for log in logs:
-        if 'time' not in log or 'message' not in log:
+    for log_time, log_message, log_topics, msg_lower in logs:
+        # Verificar si es un log relacionado con PPPoE: si el router clasificó
+        # el log se confía en sus topics; si no, se buscan términos en el mensaje
+        if log_topics:
+            if 'ppp' not in log_topics:
+                continue
+        elif _TOPIC_HINT_RE.search(msg_lower) is None:
             continue
         
-        log_time = log.get('time', '')
-        log_message = log.get('message', '')
-        log_topics = log.get('topics', '')
+        # Eventos de conexión: mensajes con la etiqueta <pppoe-usuario>
+        username_match = _PPPOE_TAG_RE.search(log_message) if '<pppoe-' in log_message else None
+        if username_match:
+            username = username_match.group(1)
+            event_type = None
+            
+            # Determinar el tipo de evento
+            if 'terminating' in log_message or 'disconnected' in log_message:
+                event_type = 'DESCONEXIÓN'
+            elif 'connected' in log_message:
+                event_type = 'CONEXIÓN'
+            
+            if event_type:
+                # Guardar el evento
+                connection_events.append({
+                    'Hora': log_time,
+                    'Cliente': username,
+                    'Evento': event_type,
+                    'Mensaje': log_message
+                })
+                
+                # Verificar si es una reconexión rápida
+                prev_status = client_status.get(username)
+                if (prev_status is not None and event_type == 'CONEXIÓN' and
+                    prev_status['last_event'] == 'DESCONEXIÓN'):
+                    # Marcar como reconexión rápida
+                    connection_events.append({
+                        'Hora': log_time,
+                        'Cliente': username,
+                        'Evento': 'RECONEXIÓN RÁPIDA',
+                        'Mensaje': f"Reconexión detectada después de una desconexión"
+                    })
+                
+                # Actualizar estado del cliente
+                client_status[username] = {'last_event': event_type, 'last_time': log_time}
         
-        # Verificar si es un log relacionado con PPPoE
-        is_pppoe_log = False
-        if 'pppoe' in log_topics or 'ppp' in log_topics:
-            is_pppoe_log = True
-        else:
-            for term in ['pppoe', 'ppp', 'disconnected', 'closed','terminating...']:
-                if term in log_message.lower():
-                    is_pppoe_log = True
-                    break
+        # Si aparece 'ppp' o 'disconnected' la línea es candidata a desconexión
+        if _DISC_HINT_RE.search(msg_lower) is not None:
+            candidates.append((log_time, log_message, log_topics))
+    
+    if not candidates:
+        return disconnections, connection_events
+    
+    # Buscar patrones de desconexión en una sola pasada sobre todos los candidatos unidos;
+    # line_ends[i] es la posición donde termina la línea i (separador incluido)
+    joined = _LOG_SEPARATOR.join(log_message for _, log_message, _ in candidates)
+    line_ends = list(itertools.accumulate(
+        len(log_message) + len(_LOG_SEPARATOR) for _, log_message, _ in candidates
+    ))
+    
+    last_line = -1
+    for match in _PPPOE_DISC_UNION.finditer(joined):
+        line = bisect.bisect_right(line_ends, match.start())
+        if line == last_line:
+            continue  # Solo cuenta la primera coincidencia de cada línea
+        last_line = line
         
-        if not is_pppoe_log:
-            continue
+        log_time, log_message, log_topics = candidates[line]
+        username = next(g for g in match.groups() if g is not None)
         
-        # Buscar patrones de desconexión
-        for pattern in pppoe_patterns:
-            match = re.search(pattern, log_message, re.IGNORECASE)
-            if match:
-                username = match.group(1).strip()
-                
-                # Extraer la IP si está presente en el mensaje
-                ip_match = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', log_message)
-                ip = ip_match.group(1) if ip_match else 'N/A'
-                
-                disconnections.append({
-                    'nombre': username,
-                    'ip': ip,
-                    'tiempo_desconexion': log_time,
-                    'mensaje': log_message,
-                    'topics': log_topics
-                })
-                break
+        # Extraer la IP si está presente en el mensaje
+        ip_match = _IP_RE.search(log_message)
+        ip = ip_match.group(1) if ip_match else 'N/A'
+        
+        disconnections['nombre'].append(username)
+        disconnections['ip'].append(ip)
+        disconnections['tiempo_desconexion'].append(log_time)
+        disconnections['mensaje'].append(log_message)
+        disconnections['topics'].append(log_topics)
     
-    return disconnections
+    return disconnections, connection_events
 
 # Función para buscar desconexiones recientes
 def find_recent_disconnections(time_minutes):
     logs = get_mikrotik_logs(time_minutes)
     
     if not logs:
-        return [], []
+        return {field: [] for field in DISCONNECTION_FIELDS}, []
     
-    # Filtrar los logs para encontrar desconexiones PPPoE tradicionales
-    disconnections = filter_pppoe_disconnections(logs)
-    
-    # Extraer todos los eventos de conexión PPPoE (desconexión, conexión, reconexión)
-    connection_events = extract_pppoe_connection_events(logs)
+    # Encontrar desconexiones PPPoE y eventos de conexión en una sola pasada
+    disconnections, connection_events = scan_logs(logs)
     
     # Guardar en el archivo de registro local
     save_disconnections_to_log(disconnections)
     
     return disconnections, connection_events
 
+# Función para abrir el registro local (SQLite en modo WAL, una conexión por sesión)
+def get_log_db():
+    conn = st.session_state.get("log_db")
+    if conn is not None:
+        return conn
+    
+    # Cada ejecución de Streamlit corre en un hilo distinto dentro de la misma sesión
+    conn = sqlite3.connect(st.session_state.log_file, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS desconexiones "
+        "(timestamp TEXT, cliente TEXT, ip TEXT, mensaje TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_desconexiones_cliente "
+        "ON desconexiones (cliente, timestamp)"
+    )
+    conn.commit()
+    st.session_state.log_db = conn
+    return conn
+
 # Función para guardar desconexiones en el registro local
 def save_disconnections_to_log(disconnections):
-    if not disconnections:
+    if not disconnections['nombre']:
         return
     
-    file_exists = os.path.isfile(st.session_state.log_file)
+    # Armar las filas directamente desde las columnas
+    rows = zip(
+        disconnections['tiempo_desconexion'],
+        disconnections['nombre'],
+        disconnections['ip'],
+        disconnections['mensaje']
+    )
     
-    with open(st.session_state.log_file, mode='a', newline='') as file:
-        writer = csv.writer(file)
-        
-        # Escribir encabezados si es un archivo nuevo
-        if not file_exists:
-            writer.writerow(['Timestamp', 'Cliente', 'IP', 'Mensaje'])
-        
-        # Escribir las desconexiones
-        for dc in disconnections:
-            writer.writerow([
-                dc.get('tiempo_desconexion', datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-                dc.get('nombre', 'desconocido'),
-                dc.get('ip', 'N/A'),
-                dc.get('mensaje', 'N/A')
-            ])
+    # Escribir las desconexiones en una sola transacción
+    conn = get_log_db()
+    conn.executemany("INSERT INTO desconexiones VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+
+# Función para vaciar el registro local
+def clear_disconnection_log():
+    conn = get_log_db()
+    conn.execute("DELETE FROM desconexiones")
+    conn.commit()
+
+# Función para convertir las horas de los logs de RouterOS en fechas ordenables.
+# Según la versión, RouterOS escribe 'HH:MM:SS' para los logs de hoy y, para los de
+# días anteriores, 'mmm/dd HH:MM:SS' (sin año), 'mmm/dd/yyyy HH:MM:SS' o
+# 'YYYY-MM-DD HH:MM:SS' (7.10+); las horas no reconocidas quedan como NaT
+def parse_log_times(times, now=None):
+    now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+    times = pd.Series(times, dtype=object).astype(str).str.strip()
+    parsed = pd.Series(pd.NaT, index=times.index, dtype='datetime64[ns]')
+    
+    # Logs de hoy: se completa la fecha actual
+    today_mask = times.str.fullmatch(r"\d{1,2}:\d{2}:\d{2}")
+    parsed[today_mask] = pd.to_datetime(
+        now.strftime('%Y-%m-%d ') + times[today_mask],
+        format='%Y-%m-%d %H:%M:%S', errors='coerce'
+    )
+    
+    # Logs de días anteriores sin año: se prueba con el año actual y, si la fecha
+    # no existe o queda en el futuro, con los anteriores (un feb/29 puede
+    # necesitar retroceder hasta el último año bisiesto)
+    past_mask = times.str.fullmatch(r"[A-Za-z]{3}/\d{1,2} \d{1,2}:\d{2}:\d{2}")
+    past = pd.Series(pd.NaT, index=times.index[past_mask], dtype='datetime64[ns]')
+    for years_back in range(5):
+        pending = past.isna()
+        if not pending.any():
+            break
+        candidate = pd.to_datetime(
+            f"{now.year - years_back}/" + times[past_mask][pending],
+            format='%Y/%b/%d %H:%M:%S', errors='coerce'
+        )
+        past[pending] = candidate.where(candidate <= now)
+    parsed[past_mask] = past
+    
+    # Logs que ya traen el año
+    for pattern, date_format in [
+        (r"\d{4}-\d{2}-\d{2} \d{1,2}:\d{2}:\d{2}", '%Y-%m-%d %H:%M:%S'),
+        (r"[A-Za-z]{3}/\d{1,2}/\d{4} \d{1,2}:\d{2}:\d{2}", '%b/%d/%Y %H:%M:%S'),
+    ]:
+        full_mask = times.str.fullmatch(pattern)
+        parsed[full_mask] = pd.to_datetime(times[full_mask], format=date_format, errors='coerce')
+    
+    return parsed
 
 # Función para formatear datos para mostrar
 def format_disconnections_for_display(disconnections):
-    if not disconnections:
+    if not disconnections['nombre']:
         return pd.DataFrame()
     
-    # Crear dataframe
-    df = pd.DataFrame(disconnections)
-    
     # Renombrar columnas para mejor visualización
     columns_map = {
         'nombre': 'Cliente',
@@ -189,77 +354,27 @@ def format_disconnections_for_display(disconnections):
         'mensaje': 'Mensaje del Log'
     }
     
-    df_display = pd.DataFrame()
-    for old_col, new_col in columns_map.items():
-        if old_col in df.columns:
-            df_display[new_col] = df[old_col]
+    # Crear dataframe solo con las columnas a mostrar, ya renombradas
+    df_display = pd.DataFrame({
+        new_col: disconnections[old_col] for old_col, new_col in columns_map.items()
+    })
     
-    # Intentar ordenar por hora de desconexión si está disponible
-    if 'Hora Desconexión' in df_display.columns:
-        try:
-            # Ordenar por la hora más reciente primero
-            df_display = df_display.sort_values('Hora Desconexión', ascending=False)
-        except:
-            pass  # Si no se puede ordenar, mostrar como está
+    # Ordenar por la hora más reciente primero; las horas no reconocidas quedan al final
+    hora = parse_log_times(df_display['Hora Desconexión'])
+    df_display = (
+        df_display.assign(_hora=hora)
+        .sort_values('_hora', ascending=False, na_position='last', kind='stable')
+        .drop(columns='_hora')
+    )
     
     return df_display
 
-def extract_pppoe_connection_events(logs):
-    connection_events = []
-    
-    # Crear un diccionario para hacer seguimiento del estado de cada cliente
-    client_status = {}
-    
-    for log in logs:
-        if 'message' not in log or 'time' not in log:
-            continue
-            
-        message = log.get('message', '')
-        log_time = log.get('time', '')
-        
-        # Buscar mensajes relacionados con PPPoE
-        if '<pppoe-' in message:
-            # Extraer el nombre de usuario
-            username_match = re.search(r'<pppoe-(.*?)>', message)
-            if not username_match:
-                continue
-                
-            username = username_match.group(1)
-            event_type = None
-            
-            # Determinar el tipo de evento
-            if 'terminating' in message or 'disconnected' in message:
-                event_type = 'DESCONEXIÓN'
-            elif 'connected' in message:
-                event_type = 'CONEXIÓN'
-            
-            if event_type:
-                # Guardar el evento
-                connection_events.append({
-                    'Hora': log_time,
-                    'Cliente': username,
-                    'Evento': event_type,
-                    'Mensaje': message
-                })
-                
-                # Actualizar estado del cliente
-                if username not in client_status:
-                    client_status[username] = {'last_event': event_type, 'last_time': log_time}
-                else:
-                    # Verificar si es una reconexión rápida
-                    if (event_type == 'CONEXIÓN' and 
-                        client_status[username]['last_event'] == 'DESCONEXIÓN'):
-                        # Marcar como reconexión rápida
-                        connection_events.append({
-                            'Hora': log_time,
-                            'Cliente': username,
-                            'Evento': 'RECONEXIÓN RÁPIDA',
-                            'Mensaje': f"Reconexión detectada después de una desconexión"
-                        })
-                    
-                    client_status[username] = {'last_event': event_type, 'last_time': log_time}
-    
-    return connection_events
+# Función para exportar un dataframe como CSV escribiendo directamente en bytes
+def dataframe_to_csv_buffer(df):
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding='utf-8', chunksize=1024)
+    buffer.seek(0)
+    return buffer
 
 # Función principal
 def main():
@@ -301,6 +416,13 @@ def main():
         "1 día": 1440
     }
     
+    # Resultados ya calculados en esta ejecución, para no consultar dos veces el mismo período
+    recent_results = {}
+    def get_recent_disconnections(time_minutes):
+        if time_minutes not in recent_results:
+            recent_results[time_minutes] = find_recent_disconnections(time_minutes)
+        return recent_results[time_minutes]
+    
     col1, col2 = st.columns([3, 1])
     
     with col1:
@@ -316,27 +438,36 @@ def main():
         if st.button("🔍 Buscar desconexiones"):
             with st.spinner("Consultando logs del router..."):
                 # Buscar desconexiones y eventos de conexión
-                disconnections, connection_events = find_recent_disconnections(time_options[selected_time])
+                disconnections, connection_events = get_recent_disconnections(time_options[selected_time])
                 
                 if connection_events:
                     # Mostrar todos los eventos de conexión PPPoE (incluidas reconexiones rápidas)
                     st.subheader("📊 Eventos de Conexión PPPoE:")
                     events_df = pd.DataFrame(connection_events)
                     
-                    # Resaltar las reconexiones rápidas
-                    def highlight_reconnections(row):
-                        if row['Evento'] == 'RECONEXIÓN RÁPIDA':
-                            return ['background-color: #FFC107'] * len(row)
-                        elif row['Evento'] == 'DESCONEXIÓN':
-                            return ['background-color: #F44336; color: white'] * len(row)
-                        elif row['Evento'] == 'CONEXIÓN':
-                            return ['background-color: #4CAF50; color: white'] * len(row)
-                        else:
-                            return [''] * len(row)
+                    # Resaltar las reconexiones rápidas: un color por fila según el evento
+                    row_colors = np.select(
+                        [
+                            events_df['Evento'].eq('RECONEXIÓN RÁPIDA'),
+                            events_df['Evento'].eq('DESCONEXIÓN'),
+                            events_df['Evento'].eq('CONEXIÓN')
+                        ],
+                        [
+                            'background-color: #FFC107',
+                            'background-color: #F44336; color: white',
+                            'background-color: #4CAF50; color: white'
+                        ],
+                        default=''
+                    )
+                    events_styles = pd.DataFrame(
+                        np.repeat(row_colors[:, None], events_df.shape[1], axis=1),
+                        index=events_df.index,
+                        columns=events_df.columns
+                    )
                     
                     # Mostrar la tabla con formato
                     st.dataframe(
-                        events_df.style.apply(highlight_reconnections, axis=1),
+                        events_df.style.apply(lambda _: events_styles, axis=None),
                         use_container_width=True
                     )
                     
@@ -350,18 +481,18 @@ def main():
                         st.info(f"Usuarios con reconexiones rápidas: {', '.join(reconnection_users)}")
                     
                     # Opción para exportar eventos
-                    events_csv = events_df.to_csv(index=False)
                     st.download_button(
                         label="📥 Descargar eventos de conexión como CSV",
-                        data=events_csv,
+                        data=dataframe_to_csv_buffer(events_df),
                         file_name=f"eventos_pppoe_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
                         mime="text/csv"
                     )
                 
                 # Mostrar las desconexiones tradicionales
-                if disconnections:
+                disconnection_count = len(disconnections['nombre'])
+                if disconnection_count:
                     st.subheader("🚫 Desconexiones detectadas:")
-                    st.success(f"✅ Se encontraron {len(disconnections)} desconexiones")
+                    st.success(f"✅ Se encontraron {disconnection_count} desconexiones")
                     
                     # Formatear para mostrar
                     df_display = format_disconnections_for_display(disconnections)
@@ -370,15 +501,14 @@ def main():
                     st.dataframe(df_display, use_container_width=True)
                     
                     # Opción para exportar datos
-                    csv = df_display.to_csv(index=False)
                     st.download_button(
                         label="📥 Descargar desconexiones como CSV",
-                        data=csv,
+                        data=dataframe_to_csv_buffer(df_display),
                         file_name=f"desconexiones_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
                         mime="text/csv"
                     )
                 
-                if not connection_events and not disconnections:
+                if not connection_events and not disconnection_count:
                     st.success(f"✅ No se detectaron eventos PPPoE en los últimos {selected_time}")
         
     with col2:
@@ -391,25 +521,16 @@ def main():
         # Mostrar clientes activos actuales
         if st.button("👥 Ver clientes activos"):
             with st.spinner("Consultando router..."):
-                active_clients = get_active_pppoe_users()
-                if active_clients:
-                    st.write(f"Clientes activos: **{len(active_clients)}**")
+                clients_df = get_active_pppoe_users()
+                if not clients_df.empty:
+                    st.write(f"Clientes activos: **{len(clients_df)}**")
                     
-                    clients_data = []
-                    reconnected_clients = []
-
-                    for name, data in active_clients.items():
-                        clients_data.append({
-                            "Cliente": name,
-                            "IP": data.get('ip', 'N/A')
-                        })
-
-                        # Verificar si el usuario estaba en la lista de desconectados
-                        if name in st.session_state.previous_disconnections:
-                            reconnected_clients.append(name)
+                    # Usuarios que estaban en la lista de desconectados y ahora están activos
+                    reconnected_clients = sorted(
+                        st.session_state.previous_disconnections & set(clients_df['Cliente'])
+                    )
 
                     # Mostrar tabla con clientes activos
-                    clients_df = pd.DataFrame(clients_data)
                     st.dataframe(clients_df, use_container_width=True)
 
                     # Mostrar mensaje si hay clientes que se reconectaron
@@ -422,16 +543,16 @@ def main():
                 else:
                     st.warning("No se pudieron obtener los clientes activos")
 
-        # Guardar los usuarios desconectados en session_state
-        disconnections, _ = find_recent_disconnections(15)  # Últimos 15 minutos
-        if disconnections:
-            disconnected_users = {dc['nombre'] for dc in disconnections}
-            st.session_state.previous_disconnections.update(disconnected_users)
+        # Guardar los usuarios desconectados en session_state (como mucho cada 30 segundos)
+        if time.time() - st.session_state.get("last_refresh", 0) > 30:
+            disconnections, _ = get_recent_disconnections(15)  # Últimos 15 minutos
+            st.session_state.previous_disconnections.update(disconnections['nombre'])
+            st.session_state.last_refresh = time.time()
 
         # Opción para limpiar historial
         if st.button("🗑️ Limpiar historial"):
             if os.path.exists(st.session_state.log_file):
-                os.remove(st.session_state.log_file)
+                clear_disconnection_log()
                 st.success("Historial de desconexiones limpiado")
                 st.rerun()
 